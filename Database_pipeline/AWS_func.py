@@ -1,13 +1,38 @@
 # aws_fetcher/s3_data_fetcher.py
 
 import os
+import re
+import csv
+import uuid
+import shutil
+import tempfile
 import boto3
 import zipfile
+import threading
 import pandas as pd
-from io import BytesIO
-from datetime import datetime, timedelta
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+
+MB = 1024 * 1024
+# string columns stay Arrow-backed when handed to pandas
+STRING_DTYPE = pd.ArrowDtype(pa.string())
+# "<prefix>-export-dd-mm-YYYY..." → the export date, matched right after the prefix
+EXPORT_DATE_RE = re.compile(r"-export-(\d{2})-(\d{2})-(\d{4})")
 
 class S3DataFetcher:
+    # zips above multipart_threshold are fetched as parallel byte-range GETs
+    transfer_config = TransferConfig(
+        multipart_threshold = 16 * MB,
+        multipart_chunksize = 8 * MB,
+        max_concurrency     = 16
+    )
+
     def __init__(
         self,
         aws_access_key_id: str,
@@ -15,23 +40,30 @@ class S3DataFetcher:
         buckets: dict[str,int],
         prefixes: list[str],
         output_paths: dict[str,str],
-        region_name: str = "ap-southeast-1"
+        region_name: str = "ap-southeast-1",
+        max_workers: int = 32
     ):
         """
         buckets: mapping of bucket name → country code
         prefixes: list of file‐type prefixes (e.g. ["members-data", ...])
-        output_paths: prefix → local parquet path
+        output_paths: prefix → local parquet dataset directory
+        max_workers: number of zip files downloaded concurrently
         """
         self.buckets = buckets
         self.prefixes = prefixes
         self.output_paths = output_paths
         self.region = region_name
+        self.max_workers = max_workers
 
         self.s3: boto3.client = None
-        # for each prefix we’ll collect a list of DataFrames
-        self.data_blocks: dict[str, list[pd.DataFrame]] = {
+        # for each prefix we’ll collect a list of Arrow tables
+        self.data_blocks: dict[str, list[pa.Table]] = {
             p: [] for p in prefixes
         }
+        # worker threads append to data_blocks concurrently
+        self._locks: dict[str, threading.Lock] = {
+            p: threading.Lock() for p in prefixes
+        }
 
         # credentials
         self.aws_access_key_id     = aws_access_key_id
@@ -43,29 +75,107 @@ class S3DataFetcher:
             "s3",
             aws_access_key_id     = self.aws_access_key_id,
             aws_secret_access_key = self.aws_secret_access_key,
-            region_name           = self.region
+            region_name           = self.region,
+            # every worker may run a full ranged transfer at once, so size the
+            # pool for all of their part requests and urllib3 never discards sockets
+            config                = Config(
+                max_pool_connections=self.max_workers * self.transfer_config.max_request_concurrency
+            )
         )
         print("✅ Connected to S3.")
 
-    def _list_keys(self, bucket: str, prefix: str, date: datetime) -> list[str]:
-        """Return all object keys under bucket with prefix-date."""
-        key_prefix = f"{prefix}-export-{date.strftime('%d-%m-%Y')}"
-        resp = self.s3.list_objects_v2(Bucket=bucket, Prefix=key_prefix)
-        return [obj["Key"] for obj in resp.get("Contents", [])]
+    def _list_keys_by_date(self, bucket: str, prefix: str) -> dict[date, list[tuple[str, int]]]:
+        """Return all (key, size) under bucket with prefix-export-, grouped by export date."""
+        keys_by_date: dict[date, list[tuple[str, int]]] = {}
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}-export-"):
+            for obj in page.get("Contents", []):
+                m = EXPORT_DATE_RE.match(obj["Key"], len(prefix))
+                if not m:
+                    continue
+                day, month, year = map(int, m.groups())
+                try:
+                    keys_by_date.setdefault(date(year, month, day), []).append((obj["Key"], obj["Size"]))
+                except ValueError:
+                    continue  # not a real calendar date
+        return keys_by_date
+
+    @staticmethod
+    def _dedup_names(names: list[str]) -> list[str]:
+        """Rename repeated header names to name.1, name.2, ... the way pandas does."""
+        counts: dict[str, int] = {}
+        deduped = []
+        for name in names:
+            count = counts.get(name, 0)
+            while count > 0:
+                counts[name] = count + 1
+                name = f"{name}.{count}"
+                count = counts.get(name, 0)
+            deduped.append(name)
+            counts[name] = count + 1
+        return deduped
+
+    @classmethod
+    def _read_csv(cls, f) -> pa.Table:
+        """Read one CSV stream into an Arrow table, keeping every column as string."""
+        # column_types needs the names up front, so take them from the header line
+        names = cls._dedup_names(next(csv.reader([f.readline().decode("utf-8-sig")]), []))
+        if not f.peek(1):
+            # header-only export: empty table rather than Arrow's "Empty CSV file"
+            return pa.table({name: pa.array([], pa.string()) for name in names})
+
+        short_rows = []
 
-    def _fetch_and_parse(self, bucket: str, key: str, prefix: str):
+        def on_invalid_row(row) -> str:
+            # pandas pads short rows with NaN, so remember them and re-read below;
+            # rows with too many fields are an error in both readers
+            if row.actual_columns < row.expected_columns:
+                short_rows.append(row.number)
+                return "skip"
+            return "error"
+
+        body_start = f.tell()
+        table = pacsv.read_csv(
+            f,
+            read_options    = pacsv.ReadOptions(column_names=names, use_threads=True, block_size=8 << 20),
+            parse_options   = pacsv.ParseOptions(invalid_row_handler=on_invalid_row),
+            convert_options = pacsv.ConvertOptions(
+                column_types        = {name: pa.string() for name in names},
+                strings_can_be_null = True
+            )
+        )
+        if not short_rows:
+            return table
+
+        # rare ragged file: fall back to pandas for this one CSV so short rows are kept
+        f.seek(body_start)
+        df = pd.read_csv(f, header=None, names=names, dtype=str, low_memory=False)
+        schema = pa.schema([(name, pa.string()) for name in names])
+        return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+    def _fetch_and_parse(self, bucket: str, key: str, prefix: str, size: int):
         """Download one zip file, extract CSVs and append to data_blocks[prefix]."""
         country = self.buckets[bucket]
-        obj = self.s3.get_object(Bucket=bucket, Key=key)
-        with zipfile.ZipFile(BytesIO(obj["Body"].read())) as z:
-            for fname in z.namelist():
-                if not fname.endswith(".csv"):
-                    continue
-                with z.open(fname) as f:
-                    df = pd.read_csv(f, dtype=str, low_memory=False)
-                    df["Country"] = country
-                    self.data_blocks[prefix].append(df)
-                    print(f"📦 {bucket}/{key} → {fname} ({len(df)} rows)")
+        # spool the zip to disk so only the CSV being parsed is held in memory
+        with tempfile.TemporaryFile() as tmp:
+            if size < self.transfer_config.multipart_threshold:
+                # small zip: one GET, no HeadObject round trip from the transfer manager
+                body = self.s3.get_object(Bucket=bucket, Key=key)["Body"]
+                shutil.copyfileobj(body, tmp)
+                body.close()
+            else:
+                self.s3.download_fileobj(Bucket=bucket, Key=key, Fileobj=tmp, Config=self.transfer_config)
+            tmp.seek(0)
+            with zipfile.ZipFile(tmp) as z:
+                for fname in z.namelist():
+                    if not fname.endswith(".csv"):
+                        continue
+                    with z.open(fname) as f:
+                        table = self._read_csv(f)
+                        table = table.append_column("Country", pa.array([country] * table.num_rows))
+                        with self._locks[prefix]:
+                            self.data_blocks[prefix].append(table)
+                        print(f"📦 {bucket}/{key} → {fname} ({table.num_rows} rows)")
 
     def fetch_data(
         self,
@@ -73,42 +183,108 @@ class S3DataFetcher:
         end_date:   datetime
     ) -> None:
         """
-        Loop over each day in [start_date..end_date], each bucket, each prefix,
-        download any matching zip, extract its CSVs & store in self.data_blocks.
+        List each bucket/prefix once, keep the zips dated in
+        [start_date..end_date], then download them concurrently, extract
+        their CSVs & store in self.data_blocks.
         """
         self.data_blocks = { p: [] for p in self.prefixes}
-        days = (end_date - start_date).days + 1
+        first, last = start_date.date(), end_date.date()
+        tasks: list[tuple[str, str, str, int]] = []  # (bucket, key, prefix, size)
         for bucket, _ in self.buckets.items():
             print(f"\n🔄 Bucket: {bucket}")
             for prefix in self.prefixes:
-                for offset in range(days):
-                    date = start_date + timedelta(days=offset)
-                    keys = self._list_keys(bucket, prefix, date)
-                    if not keys:
-                        continue
-                    print(f"  🔍 {prefix} @ {date.strftime('%d-%m-%Y')}: {len(keys)} files")
-                    for key in keys:
-                        self._fetch_and_parse(bucket, key, prefix)
+                keys_by_date = self._list_keys_by_date(bucket, prefix)
+                for day in sorted(d for d in keys_by_date if first <= d <= last):
+                    keys = keys_by_date[day]
+                    print(f"  🔍 {prefix} @ {day.strftime('%d-%m-%Y')}: {len(keys)} files")
+                    tasks.extend((bucket, key, prefix, size) for key, size in keys)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(self._fetch_and_parse, bucket, key, prefix, size)
+                for bucket, key, prefix, size in tasks
+            ]
+            for future in as_completed(futures):
+                future.result()  # re-raise any download/parse error
+
+    @staticmethod
+    def _read_legacy(path: str, tables: list[pa.Table]) -> pa.Table:
+        """
+        Read the old single parquet file with its columns cast to the types of
+        this run's tables (all string), so it concatenates with them.
+        Pandas index columns are dropped, as pd.concat(ignore_index=True) did.
+        """
+        legacy = pq.read_table(path)
+        meta = legacy.schema.pandas_metadata or {}
+        index_cols = [c for c in meta.get("index_columns", []) if isinstance(c, str)]
+        legacy = legacy.drop_columns(index_cols)
+        target = {f.name: f.type for t in reversed(tables) for f in t.schema}
+        columns = []
+        for name, column in zip(legacy.column_names, legacy.columns):
+            # e.g. large_string from pandas 3 vs string from _read_csv
+            type_ = target.get(name, pa.string() if pa.types.is_large_string(column.type) else column.type)
+            columns.append(column.cast(type_) if column.type != type_ else column)
+        return pa.table(columns, names=legacy.column_names)
+
+    @staticmethod
+    def _distinct(table: pa.Table) -> pa.Table:
+        """Drop duplicate rows natively in Arrow."""
+        # grouping on every column with no aggregates == SELECT DISTINCT *
+        return table.group_by(table.column_names, use_threads=False).aggregate([])
+
+    @staticmethod
+    def _write_dataset(table: pa.Table, out_dir: str, existing_data_behavior: str):
+        """Write table under out_dir as zstd parquet, one hive partition per Country."""
+        ds.write_dataset(
+            table,
+            out_dir,
+            format                 = "parquet",
+            partitioning           = ds.partitioning(pa.schema([table.schema.field("Country")]), flavor="hive"),
+            # unique file names so every run adds files instead of replacing them
+            basename_template      = f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+            existing_data_behavior = existing_data_behavior,
+            file_options           = ds.ParquetFileFormat().make_write_options(compression="zstd")
+        )
 
     def combine_dataframes(self) -> dict[str, pd.DataFrame]:
         """
-        For each prefix, concat all collected DataFrames, drop duplicates,
+        For each prefix, concat all collected Arrow tables, drop duplicates,
+        append them as new files to the parquet dataset at output_paths[prefix]
         and store the combined DataFrame in self.data_blocks.
+        Only this run's rows are read and written; duplicates against earlier
+        runs are removed by compact_dataset().
         Returns a dict mapping prefix -> combined DataFrame.
         """
         combined_blocks: dict[str, pd.DataFrame] = {}
-        for prefix, dfs in self.data_blocks.items():
-            dfs_to_concat = list(dfs)  # copy
+        for prefix, tables in self.data_blocks.items():
+            tables_to_concat = list(tables)  # copy
             out_path = self.output_paths.get(prefix)
-            if out_path and os.path.exists(out_path):
-                existing = pd.read_parquet(out_path)
-                dfs_to_concat.insert(0, existing)
+            backup_path = f"{out_path}.bak" if out_path else None
+            # one-off migration: the old single parquet file, or a .bak left behind
+            # by a run whose dataset write failed, is folded into this run's rows
+            legacy_path = next(
+                (p for p in (out_path, backup_path) if p and os.path.isfile(p)), None
+            )
+            if legacy_path:
+                tables_to_concat.insert(0, self._read_legacy(legacy_path, tables))
 
-            if not dfs_to_concat:
+            if not tables_to_concat:
                 print(f"⚠️ No data for prefix '{prefix}', skipping.")
                 continue
 
-            combined = pd.concat(dfs_to_concat, ignore_index=True).drop_duplicates()
+            # concat_tables only stitches chunks together; pandas is built once here
+            table = self._distinct(pa.concat_tables(tables_to_concat, promote_options="permissive"))
+            if legacy_path == out_path:
+                # only moved aside once it has been read, so the dataset directory can take its path
+                os.replace(out_path, backup_path)
+                legacy_path = backup_path
+            if out_path:
+                self._write_dataset(table, out_path, existing_data_behavior="overwrite_or_ignore")
+            if legacy_path:
+                # only drop the old file once its rows are safely in the dataset
+                os.remove(legacy_path)
+
+            combined = table.to_pandas(types_mapper={pa.string(): STRING_DTYPE}.get)
             combined_blocks[prefix] = combined
             # also overwrite in-place if you want
             self.data_blocks[prefix] = combined
@@ -117,6 +293,28 @@ class S3DataFetcher:
 
         return combined_blocks
 
+    def compact_dataset(self, prefix: str) -> None:
+        """
+        Rewrite the dataset for prefix with duplicates dropped across all runs.
+        Meant to be run periodically rather than on every fetch.
+        """
+        out_dir = self.output_paths[prefix]
+        discovered = ds.dataset(out_dir, format="parquet", partitioning="hive")
+        # the discovered schema comes from a single file; unify every file's schema
+        # (plus the partition columns) so columns added by later runs aren't dropped
+        schema = pa.unify_schemas(
+            [frag.physical_schema for frag in discovered.get_fragments()] + [discovered.partitioning.schema]
+        )
+        dataset = ds.dataset(out_dir, format="parquet", partitioning="hive", schema=schema)
+        table = self._distinct(dataset.to_table())
+
+        tmp_dir, old_dir = f"{out_dir}.compacting", f"{out_dir}.old"
+        self._write_dataset(table, tmp_dir, existing_data_behavior="error")
+        os.replace(out_dir, old_dir)
+        os.replace(tmp_dir, out_dir)
+        shutil.rmtree(old_dir)
+        print(f"🧹 Compacted '{prefix}' to {table.num_rows} rows")
+
     def close(self):
         """Nothing to close for boto3, but provided for symmetry."""
         print("🔒 S3DataFetcher done.")
@@ -1,9 +1,24 @@
 import os
+import asyncio
+import aiohttp
+import orjson
+import operator
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+import pyarrow as pa
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 #start = time.time()
+
+# throttling / transient server errors worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# pandas dtype for OData string fields
+STRING_DTYPE = pd.ArrowDtype(pa.string())
+
 class D365ODataFetcher:
     def __init__(
         self,
@@ -12,7 +27,10 @@ class D365ODataFetcher:
         base_url: str,
         date_map: dict[str, str] | None = None,
         required_fields: list[str] | None = None,
-        page_size: int = 100_000
+        page_size: int = 100_000,
+        max_concurrency: int = 32,
+        max_retries: int = 5,
+        max_workers: int = 16
 
     ):
         """
@@ -21,6 +39,9 @@ class D365ODataFetcher:
         base_url: the OData endpoint URL
         required_fields: list of OData fields to pull
         page_size: number of records per page
+        max_concurrency: number of OData pages in flight at once, shared by all workers
+        max_retries: retries per page on throttling / server errors
+        max_workers: number of (country, date) fetches run at once
         """
         self.tenant_id       = tenant_id
         self.creds           = creds
@@ -28,6 +49,39 @@ class D365ODataFetcher:
         self.required_fields = required_fields
         self.page_size       = page_size
         self.date_map        = date_map
+        self.max_concurrency = max_concurrency
+        self.max_retries     = max_retries
+        self.max_workers     = max_workers
+        # country -> (access token, monotonic time after which to refresh it)
+        self._token_cache: dict[str, tuple[str, float]] = {}
+        self._token_lock = threading.Lock()
+
+        # one pooled keep-alive session for token and page requests, so TLS
+        # handshakes are paid once per connection rather than once per call
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections = 32,
+            pool_maxsize     = 64,
+            max_retries      = Retry(
+                total                      = max_retries,
+                backoff_factor             = 0.5,
+                status_forcelist           = RETRY_STATUSES,
+                allowed_methods            = frozenset({"GET", "POST"}),
+                respect_retry_after_header = True,
+                # hand the last response back so raise_for_status reports it
+                raise_on_status            = False
+            )
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # one event loop thread runs the page fetches for every worker, so the
+        # aiohttp session, its connections and the page limit are all shared
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread: threading.Thread | None = None
+        self._loop_lock = threading.Lock()
+        self._aio_session: aiohttp.ClientSession | None = None
+        self._aio_sem: asyncio.Semaphore | None = None
 
     def _get_date_field(self) -> str:
         if not self.date_map:
@@ -38,7 +92,22 @@ class D365ODataFetcher:
         return "TransDate"
 
 
-    def _get_token(self, client_id: str, client_secret: str) -> str:
+    def _get_token(self, country: str) -> str:
+        """
+        Return a bearer token for the country, reusing the cached one until
+        a minute before it expires.
+        """
+        with self._token_lock:
+            cached = self._token_cache.get(country)
+            if cached and time.monotonic() < cached[1]:
+                return cached[0]
+
+            cred = self.creds[country]
+            token, expires_in = self._request_token(cred["client_id"], cred["client_secret"])
+            self._token_cache[country] = (token, time.monotonic() + expires_in - 60)
+            return token
+
+    def _request_token(self, client_id: str, client_secret: str) -> tuple[str, int]:
         url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/token"
         payload = {
             "grant_type":    "client_credentials",
@@ -46,24 +115,85 @@ class D365ODataFetcher:
             "client_secret": client_secret,
             "resource":      "https://th-prod.operations.dynamics.com"
         }
-        r = requests.post(url, data=payload)
+        r = self.session.post(url, data=payload)
         try:
             r.raise_for_status()
         except requests.HTTPError:
             # print full error body for diagnostics
             print("❌ Token fetch failed:", r.status_code, r.text)
             raise
-        return r.json()["access_token"]
+        body = r.json()
+        # v1 endpoint returns expires_in as a string; tokens last ~1h
+        return body["access_token"], int(body.get("expires_in", 3600))
+
+    @staticmethod
+    def _retry_delay(resp_headers, attempt: int) -> float:
+        """Honour Retry-After (in seconds) if the server sent one, else back off exponentially."""
+        try:
+            return float(resp_headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return float(2 ** attempt)
+
+    async def _get_page(self, url: str, headers: dict[str, str]) -> dict:
+        """GET one OData page, retrying on 429/5xx and connection errors."""
+        for attempt in range(self.max_retries + 1):
+            # hold a slot only for the request itself, not while backing off
+            async with self._aio_sem:
+                try:
+                    async with self._aio_session.get(url, headers=headers) as resp:
+                        if resp.status in RETRY_STATUSES and attempt < self.max_retries:
+                            delay = self._retry_delay(resp.headers, attempt)
+                        else:
+                            resp.raise_for_status()
+                            return orjson.loads(await resp.read())
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self._retry_delay({}, attempt)
+            await asyncio.sleep(delay)
+
+    async def _fetch_pages(self, urls: list[str], headers: dict[str, str]) -> list[dict]:
+        """Fetch all page URLs concurrently; results come back in URL order."""
+        if self._aio_session is None:
+            # created lazily inside the loop thread; no await between check and set
+            self._aio_sem = asyncio.Semaphore(self.max_concurrency)
+            self._aio_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.max_concurrency)
+            )
+        return await asyncio.gather(*(self._get_page(url, headers) for url in urls))
+
+    def _run_async(self, coro):
+        """Run coro on the shared event loop thread and wait for its result."""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+                self._loop_thread.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def close(self):
+        """Close the HTTP sessions and stop the shared event loop."""
+        self.session.close()
+        with self._loop_lock:
+            if self._loop is not None:
+                if self._aio_session is not None:
+                    asyncio.run_coroutine_threadsafe(self._aio_session.close(), self._loop).result()
+                    self._aio_session = None
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop_thread.join()
+                self._loop.close()
+                self._loop, self._loop_thread = None, None
+        print("🔒 D365ODataFetcher closed.")
 
     def _fetch_for_country_on_date(
-        self, country: str, single_date: datetime, token: str
+        self, country: str, single_date: datetime
     ) -> pd.DataFrame:
         """
         Fetch OData just for one country on one date.
         Returns a DataFrame, with only self.required_fields if set.
         """
         date_str = single_date.strftime("%Y-%m-%d")
-        headers  = {"Authorization": f"Bearer {token}"}
+        headers  = {"Authorization": f"Bearer {self._get_token(country)}"}
         date_field = self._get_date_field()
         #auth_fetch = time.time()
         #print(f"Auth fetch {auth_fetch - start}")
@@ -75,27 +205,58 @@ class D365ODataFetcher:
         ) 
 
         select_clause = f"&$select={','.join(self.required_fields)}" if self.required_fields else ""
-        next_url = f"{self.base_url}?{flt}&$top={self.page_size}{select_clause}"
+        query_url = f"{self.base_url}?{flt}&$top={self.page_size}{select_clause}"
         #run_fetch = time.time()
         #print(f"run fetch {run_fetch - start}")
-        all_records = []
+
+        # first page tells us the total row count and the server's real page length
+        resp = self.session.get(f"{query_url}&$count=true", headers=headers)
+        resp.raise_for_status()
+        data = orjson.loads(resp.content)
+        pages = [data.get("value", [])]
+        next_url = data.get("@odata.nextLink")
+        total = data.get("@odata.count")
+        stride = len(pages[0])
+
+        if next_url and total and stride:
+            # every remaining page is addressable via $skip, so fetch them all at once
+            urls = [f"{query_url}&$skip={skip}" for skip in range(stride, total, stride)]
+            pages.extend(page.get("value", []) for page in self._run_async(self._fetch_pages(urls, headers)))
+        else:
+            # no count from the server: follow the OData continuation link
+            while next_url:
+                resp = self.session.get(next_url, headers=headers)
+                resp.raise_for_status()
+                data = orjson.loads(resp.content)
+                pages.append(data.get("value", []))
+                next_url = data.get("@odata.nextLink")
+
         #n = 0
-        while next_url:
-            resp = requests.get(next_url, headers=headers)
-            resp.raise_for_status()
-            data = resp.json()
-
-            page_data = data.get("value", [])
-            if self.required_fields:
-                all_records.extend([{k: r.get(k) for k in self.required_fields} for r in page_data])
+        if self.required_fields:
+            # fill one buffer per field so no per-row dict is ever built
+            fields = self.required_fields
+            col_bufs: dict[str, list] = {k: [] for k in fields}
+            bufs = [col_bufs[k] for k in fields]
+            getter = operator.itemgetter(*fields)
+            for page_data in pages:
+                try:
+                    # itemgetter with a single field returns the bare value, not a tuple
+                    rows = map(getter, page_data) if len(fields) > 1 else ((getter(r),) for r in page_data)
+                    columns = list(zip(*rows))
+                except KeyError:
+                    # a row left out a selected field; fall back to .get() for this page
+                    columns = [[r.get(k) for r in page_data] for k in fields]
+                for buf, column in zip(bufs, columns):
+                    buf.extend(column)
                 #n += 1
-            else:
+            # build the DataFrame once all pages are fetched
+            df = pa.table(col_bufs).to_pandas(types_mapper={pa.string(): STRING_DTYPE}.get)
+        else:
+            all_records = []
+            for page_data in pages:
                 all_records.extend(page_data)
-            # follow the OData continuation link
-            next_url = data.get("@odata.nextLink")
-
-        # build the DataFrame once all pages are fetched
-        df = pd.DataFrame(all_records)
+            # build the DataFrame once all pages are fetched
+            df = pd.DataFrame(all_records)
         df["Country"]   = country
         df["FetchDate"] = single_date
         #print(f"Records fetched: {n}")
@@ -103,6 +264,63 @@ class D365ODataFetcher:
         #print(f"Fetch end {fetch_end - start}")
         return df
 
+    def _fetch_many(
+        self, countries: list[str], dates: list[datetime]
+    ) -> pd.DataFrame:
+        """
+        Fetch every (country, date) pair concurrently.
+        Tokens come from the per-country cache, so a long range only
+        re-authenticates when a token is about to expire; countries whose
+        token or fetch fails are skipped. Frames are concatenated in
+        (date, country) order regardless of completion order.
+        """
+        #before_token = time.time()
+        #print(f"Before Auth {before_token - start}")
+        authed = []
+        for country in countries:
+            try:
+                self._get_token(country)
+                authed.append(country)
+                #print("Authentication run")
+            except Exception as e:
+                print(f"❌ Skipping {country} due to token error: {e}")
+        #after_token = time.time()
+        #print(f"After Auth {after_token - start}")
+
+        pairs = [(country, day) for day in dates for country in authed]
+        results: dict[tuple[str, datetime], pd.DataFrame] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for country, day in pairs:
+                print(f"→ Fetching {country} on {day.date()}")
+                future = executor.submit(self._fetch_for_country_on_date, country, day)
+                futures[future] = (country, day)
+
+            for future in as_completed(futures):
+                country, day = futures[future]
+                try:
+                    df_country = future.result()
+                    #print("frame joining")
+
+                    if self.required_fields:
+                        cols_to_keep = self.required_fields + ["Country", "FetchDate"]
+                        # guard in case Country/FetchDate weren’t already in df_country
+                        cols_to_keep = [c for c in cols_to_keep if c in df_country.columns]
+                        df_country = df_country[cols_to_keep]
+
+                    results[(country, day)] = df_country
+
+                except Exception as e:
+                    print(f"❌ Skipping {country} for {day.date()} due to fetch error: {e}")
+
+        frames = [results[pair] for pair in pairs if pair in results]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    @staticmethod
+    def _daterange(start: datetime, end: datetime) -> list[datetime]:
+        """Every day in [start..end], inclusive."""
+        return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
     def fetch_country_range(
         self,
         country: str,
@@ -113,20 +331,9 @@ class D365ODataFetcher:
         Fetch data for a single country over a date range [start..end], inclusive.
         Returns one concatenated DataFrame.
         """
-        curr = start
-        frames = []
-        while curr <= end:
-            print(f"→ Fetching {country} on {curr.date()}")
-            df = self._fetch_for_country_on_date(country, curr)
-            frames.append(df)
-            curr += timedelta(days=1)
-
-        if frames:
-            result = pd.concat(frames, ignore_index=True)
-            # drop duplicates by your unique key
-            return result.drop_duplicates()
-        else:
-            return pd.DataFrame()
+        result = self._fetch_many([country], self._daterange(start, end))
+        # drop duplicates by your unique key
+        return result.drop_duplicates()
 
     def fetch_all_countries_on_date(
         self, single_date: datetime
@@ -135,39 +342,7 @@ class D365ODataFetcher:
         Authenticate once per country and fetch data for the given date.
         Fetch for all countries on a single date.
         """
-        #before_token = time.time()
-        #print(f"Before Auth {before_token - start}")
-        country_token_map = {}
-        for country, cred in self.creds.items():
-            try:
-                token = self._get_token(cred["client_id"], cred["client_secret"])
-                country_token_map[country] = token
-                #print("Authentication run")
-            except Exception as e:
-                print(f"❌ Skipping {country} for {single_date.date()} due to token error: {e}")
-        #after_token = time.time()
-        #print(f"After Auth {after_token - start}")
-        
-        frames = []
-        for country, token in country_token_map.items():
-            print(f"→ Fetching {country} on {single_date.date()}")
-            try:
-                df_country = self._fetch_for_country_on_date(country, single_date, token)
-                #print("frame joining")
-
-                if self.required_fields:
-                    cols_to_keep = self.required_fields + ["Country", "FetchDate"]
-                    # guard in case Country/FetchDate weren’t already in df_country
-                    cols_to_keep = [c for c in cols_to_keep if c in df_country.columns]
-                    df_country = df_country[cols_to_keep]
-
-            
-                frames.append(df_country)
-            
-            except Exception as e:
-                print(f"❌ Skipping {country} for {single_date.date()} due to fetch error: {e}")
-                
-        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        return self._fetch_many(list(self.creds), [single_date])
 
     def fetch_all_countries_range(
         self,
@@ -176,15 +351,11 @@ class D365ODataFetcher:
     ) -> pd.DataFrame:
         """
         Fetch for all countries over a date range.
+        Authenticates once per country for the whole range and fetches
+        every (country, date) pair concurrently.
         Returns one concatenated DataFrame.
         """
-        curr = start
-        frames = []
-        while curr <= end:
-            df_day = self.fetch_all_countries_on_date(curr)
-            frames.append(df_day)
-            curr += timedelta(days=1)
-        if frames:
-            df = pd.concat(frames, ignore_index=True)
-            return df.drop_duplicates(subset=["InventTransId"])
-        return pd.DataFrame()
+        df = self._fetch_many(list(self.creds), self._daterange(start, end))
+        if df.empty:
+            return df
+        return df.drop_duplicates(subset=["InventTransId"])
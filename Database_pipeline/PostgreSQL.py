@@ -1,8 +1,21 @@
+import io
+import re
 import psycopg2
 from psycopg2 import sql
 from psycopg2 import errors
-from psycopg2.extras import execute_values
 import pandas as pd
+import pyarrow as pa
+
+# queries that can run behind DECLARE ... CURSOR: SELECT/VALUES, after any
+# leading comments or opening parentheses
+STREAMABLE_QUERY_RE = re.compile(r"\s*(?:(?:--[^\n]*\n|/\*.*?\*/)\s*)*(?:\(\s*)*(?:select|values)\b", re.I | re.S)
+
+def _arrow_safe(type_: pa.DataType) -> bool:
+    """Arrow types whose pandas conversion matches pd.DataFrame(rows).
+    Structs (jsonb), lists (arrays) and decimals (numeric) are re-shaped by
+    Arrow, so chunks holding them go through pandas directly."""
+    return (pa.types.is_null(type_) or pa.types.is_boolean(type_) or pa.types.is_integer(type_)
+            or pa.types.is_floating(type_) or pa.types.is_string(type_) or pa.types.is_temporal(type_))
 
 class PostgresClient:
     def __init__(self, host: str, port: int, database: str, user: str, password: str, schemas: str) -> None:
@@ -58,32 +71,91 @@ class PostgresClient:
         self.cursor.execute(sql)
         return [row[0] for row in self.cursor.fetchall()]
     
-    def run_query(self, sql: str) -> pd.DataFrame:
+    def _query_cursor(self, streamable: bool, chunk_size: int):
+        """Server-side cursor for plain SELECT/VALUES, the shared cursor for anything else."""
+        if not streamable:
+            return self.cursor
+        cursor = self.conn.cursor(name="chunked_q", withhold=False)
+        cursor.itersize = chunk_size
+        return cursor
+
+    def run_query(self, sql: str, chunk_size: int = 50_000) -> pd.DataFrame:
+        """
+        Runs a query and returns the result as a DataFrame.
+        Plain SELECT/VALUES queries run on a server-side cursor; other
+        row-returning statements (SHOW, EXPLAIN, ... RETURNING, data-modifying
+        CTEs) run on the regular cursor. Rows are pulled chunk_size at a time
+        and each chunk is turned into an Arrow table column-wise, so the full
+        list of row tuples is never held.
+        """
         # always clear any prior aborted transaction
         try:
             self.conn.rollback()
         except Exception:
             pass
 
+        # DECLARE ... CURSOR FOR only accepts SELECT or VALUES
+        streamable = bool(STREAMABLE_QUERY_RE.match(sql))
+        cursor = self._query_cursor(streamable, chunk_size)
         try:
-            self.cursor.execute(sql)
-        except errors.InFailedSqlTransaction:
-            # clear the bad transaction then retry once
-            self.conn.rollback()
-            self.cursor.execute(sql)
+            try:
+                cursor.execute(sql)
+            except errors.InFailedSqlTransaction:
+                # clear the bad transaction then retry once
+                self.conn.rollback()
+                cursor = self._query_cursor(streamable, chunk_size)
+                cursor.execute(sql)
+
+            # now fetch results; a named cursor only has a description after the first fetch
+            rows = cursor.fetchmany(chunk_size)
+            cols = [desc[0] for desc in cursor.description]
+            tables: list[pa.Table] = []
+            frames: list[pd.DataFrame] = []  # fallback for values Arrow can't type or would reshape (uuid, jsonb, arrays, numeric)
+            use_arrow = True
+            while rows:
+                if use_arrow:
+                    try:
+                        arrays = [pa.array(values) for values in zip(*rows)]
+                        if not all(_arrow_safe(a.type) for a in arrays):
+                            raise pa.ArrowTypeError("column type does not round-trip through Arrow")
+                        tables.append(pa.Table.from_arrays(arrays, names=cols))
+                    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, OverflowError):
+                        use_arrow = False
+                        frames = [t.to_pandas() for t in tables]
+                        tables = []
+                if not use_arrow:
+                    frames.append(pd.DataFrame(rows, columns=cols))
+                # errors raised while rows are produced (e.g. division by zero) surface here
+                rows = cursor.fetchmany(chunk_size)
         except Exception as e:
-            # any other error: roll back and re-raise
+            # any error while executing or fetching: roll back and re-raise
             self.conn.rollback()
             raise RuntimeError(f"❌ Query failed: {e}")
+        finally:
+            if cursor is not self.cursor:
+                try:
+                    cursor.close()
+                except psycopg2.Error:
+                    pass  # already gone with the rolled-back transaction
 
-        # now fetch results
-        cols = [desc[0] for desc in self.cursor.description]
-        rows = self.cursor.fetchall()
-        return pd.DataFrame(rows, columns=cols)
+        if not use_arrow:
+            return pd.concat(frames, ignore_index=True)
+        if not tables:
+            return pd.DataFrame(columns=cols)
+        try:
+            # permissive promotion handles chunks that were all-NULL or int vs float
+            table = pa.concat_tables(tables, promote_options="permissive")
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # chunks inferred incompatible types (e.g. text then ints): mixed object column, as pandas would give
+            return pd.concat([t.to_pandas() for t in tables], ignore_index=True)
+        return table.to_pandas(self_destruct=True)
 
-    def insert_dataframe(self, table: str, df: pd.DataFrame) -> None:
+    def insert_dataframe(self, table: str, df: pd.DataFrame, page_size: int = 10_000) -> None:
         """
-        Bulk-inserts a DataFrame into the specified schema.table.
+        Bulk-loads a DataFrame into the specified schema.table.
+        Rows are streamed with COPY into a temporary staging table, page_size
+        rows at a time, and then moved across with INSERT ... ON CONFLICT
+        DO NOTHING, so existing rows are still skipped.
         Uses psycopg2.sql to safely quote identifiers.
         """
         try:
@@ -91,22 +163,36 @@ class PostgresClient:
             schema, tbl = table.split(".", 1)
 
             # build a list of Identifier objects for each column
-            identifiers = [sql.Identifier(col) for col in df.columns]
+            columns = sql.SQL(", ").join(sql.Identifier(col) for col in df.columns)
+            target = sql.SQL("{}.{}").format(sql.Identifier(schema), sql.Identifier(tbl))
+            staging = sql.Identifier(f"_staging_{tbl}")
 
-            # build the INSERT statement with placeholders for the VALUES block
-            template = sql.SQL("INSERT INTO {}.{} ({}) VALUES %s ON CONFLICT DO NOTHING").format(
-                sql.Identifier(schema),
-                sql.Identifier(tbl),
-                sql.SQL(", ").join(identifiers)
+            # staging copy of just these columns, with the target's types and no constraints
+            self.cursor.execute(
+                sql.SQL("CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA").format(
+                    staging, columns, target
+                )
             )
 
-            # extract row tuples
-            values = [tuple(row) for row in df.to_numpy()]
+            copy_stmt = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT CSV, DELIMITER E'\\t', NULL '\\N')").format(
+                staging, columns
+            )
+            # serialise page by page to tab-separated CSV (NULLs written as \N),
+            # so only page_size rows are ever held as text
+            for start in range(0, len(df), page_size):
+                buf = io.StringIO()
+                df.iloc[start:start + page_size].to_csv(buf, index=False, header=False, sep="\t", na_rep="\\N")
+                buf.seek(0)
+                self.cursor.copy_expert(copy_stmt, buf)
 
-            # execute_values handles the bulk insert efficiently
-            execute_values(self.cursor, template, values)
+            self.cursor.execute(
+                sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT DO NOTHING").format(
+                    target, columns, columns, staging
+                )
+            )
+            inserted = self.cursor.rowcount
             self.conn.commit()
-            print(f"✅ Inserted {len(values)} rows into '{schema}.{tbl}'.")
+            print(f"✅ Inserted {inserted} of {len(df)} rows into '{schema}.{tbl}'.")
         except Exception as e:
             self.conn.rollback()
             raise RuntimeError(f"❌ Insert {tbl} failed: {e}")
@@ -1,30 +1,41 @@
 # sftp_fetcher/sftp_data_fetcher.py
 
 import os
+import re
+import calendar
+import queue
+from collections import deque
+from itertools import islice
 import numpy as np
 import pandas as pd
-from io import StringIO
+import pyarrow as pa
+from io import BytesIO, StringIO
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import paramiko
-from pyspark.sql import SparkSession
-from pyspark.sql.types import StructType, StringType, StructField
-import tempfile
+import polars as pl
+
+# Arrow-backed pandas strings: one UTF-8 buffer per column instead of a PyObject per cell
+STRING_DTYPE = pd.ArrowDtype(pa.string())
 
 class SFTPDataFetcher:
-    def __init__(self, hostname, username, password, folder='db', file_prefix="", keys: list[str] = None):
+    def __init__(self, hostname, username, password, folder='db', file_prefix="", keys: list[str] = None,
+                 max_workers: int = 8):
         self.hostname = hostname
         self.username = username
         self.password = password
         self.folder = folder
         self.file_prefix = file_prefix
+        # last "_"-separated segment "YYYY-M(M)-D(D)" → the file date as three ints
+        self._date_re = re.compile(r"(?:^|_)(\d{4})-(\d{1,2})-(\d{1,2})$")
         self.ssh = None
         self.sftp = None
         self.keys = keys or None
+        # number of SFTP channels (and threads) used to download files in parallel
+        self.max_workers = max_workers
         self.start_date = None
         self.end_date = None
         self.data_blocks = {}
-        # Initialize Spark session
-        self.spark = SparkSession.builder.appName("SFTPDataFetcher").getOrCreate()
 
     def set_date_range(self, start: str, end: str):
         self.start_date = datetime.strptime(start, "%d-%m-%Y")
@@ -38,16 +49,24 @@ class SFTPDataFetcher:
         print("✅ Connected to SFTP server.")
 
     def _filter_files_by_date(self, files):
+        # compare (year, month, day) tuples instead of building a datetime per file
+        start = (self.start_date.year, self.start_date.month, self.start_date.day)
+        end = (self.end_date.year, self.end_date.month, self.end_date.day)
+        search = self._date_re.search
         filtered = []
         for file in files:
-            if self.file_prefix in file:
-                try:
-                    file_date_str = file.split("_")[-1]
-                    file_date = datetime.strptime(file_date_str, "%Y-%m-%d")
-                    if self.start_date <= file_date <= self.end_date:
-                        filtered.append(file)
-                except Exception:
-                    continue
+            if self.file_prefix not in file:
+                continue
+            m = search(file)
+            if not m:
+                continue
+            file_date = tuple(map(int, m.groups()))
+            year, month, day = file_date
+            # reject impossible dates such as 2024-02-30 or 2024-13-01, as strptime did
+            if not (1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1]):
+                continue
+            if start <= file_date <= end:
+                filtered.append(file)
         return sorted(filtered)
 
     def fetch_files(self):
@@ -57,64 +76,91 @@ class SFTPDataFetcher:
         print(f"📂 {len(filtered)} matching files found.")
         return filtered
 
+    def _download(self, clients: queue.Queue, file) -> bytes:
+        """Download one file on whichever SFTP channel is free."""
+        sftp = clients.get()
+        try:
+            buf = BytesIO()
+            # getfo pipelines the read requests instead of one round trip per block
+            sftp.getfo(f"{self.folder}/{file}", buf)
+            return buf.getvalue()
+        finally:
+            clients.put(sftp)
+
+    def _download_files(self, files):
+        """
+        Yield (file, content bytes) in the order given, downloading ahead over
+        several SFTP channels that share the one SSH connection. At most one
+        download per channel is in flight or waiting to be consumed.
+        """
+        if not files:
+            return
+        n = min(self.max_workers, len(files))
+        channels = [self.ssh.open_sftp() for _ in range(n)]
+        clients = queue.Queue()
+        for sftp in channels:
+            clients.put(sftp)
+        try:
+            with ThreadPoolExecutor(max_workers=n) as executor:
+                pending = iter(files)
+                in_flight = deque()
+                for file in islice(pending, n):
+                    in_flight.append((file, executor.submit(self._download, clients, file)))
+                while in_flight:
+                    file, future = in_flight.popleft()
+                    data = future.result()
+                    # refill only as results are handed out, bounding read-ahead to n bodies
+                    for nxt in islice(pending, 1):
+                        in_flight.append((nxt, executor.submit(self._download, clients, nxt)))
+                    yield file, data
+        finally:
+            for sftp in channels:
+                sftp.close()
+
     def fetch_rawdata(self, files):
         """Combine all raw CSV data from filtered files."""
-        combined_raw_df = pd.DataFrame()
+        frames: list[pd.DataFrame] = []
 
-        for file in files:
-            remote_path = f"{self.folder}/{file}"
-            with self.sftp.open(remote_path, 'r') as remote_file:
-                content = remote_file.read().decode("utf_8").strip()
+        for file, data in self._download_files(files):
+            content = data.decode("utf_8").strip()
 
             if not content:
                 print(f"⚠️ Empty file: {file}")
                 continue
 
             try:
-                df = pd.read_csv(StringIO(content), delimiter=",", dtype=str)
-                df = pd.concat([pd.DataFrame([df.columns.tolist()], columns=df.columns), df], ignore_index=True)
-                df["datablock"] = df[df.columns[0]].astype(str).str[:3]
-                combined_raw_df = pd.concat([combined_raw_df, df], ignore_index=True)
+                # header=None: the first line is data like every other line (columns are 0..N-1)
+                df = pd.read_csv(
+                    StringIO(content), sep=",", header=None, engine="c", dtype=STRING_DTYPE,
+                    na_filter=False, low_memory=False
+                )
+                df["datablock"] = df[df.columns[0]].str[:3]
+                frames.append(df)
             except Exception as e:
                 print(f"❌ Failed to process {file}: {e}")
 
-        return combined_raw_df
+        # one concat at the end instead of re-copying the accumulated frame per file
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
 
-    def fetch_rawdata_spark(self, files):
-        spark = self.spark
+    def fetch_rawdata_polars(self, files) -> pl.DataFrame:
+        """Combine all raw CSV data from filtered files into one Polars DataFrame."""
         raw_dfs = []
 
-        default_schema = StructType([
-            StructField("col_0", StringType(), True),
-            StructField("col_1", StringType(), True)
-        ])
-
-        for file in files:
-            remote_path = f"{self.folder}/{file}"
-            with self.sftp.open(remote_path, 'r') as remote_file:
-                content = remote_file.read().decode("utf_8").strip()
+        for file, data in self._download_files(files):
+            content = data.strip()
 
             if not content:
                 print(f"⚠️ Empty file: {file}")
                 continue
 
             try:
-                # Spark can't read from string, so we simulate a file with StringIO
-                with tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".csv") as tmp:
-                    tmp.write(content)
-                    tmp_path = tmp.name
-
-                # Read using Spark
-                temp_df = spark.read.csv(tmp_path, header=True, sep=",", inferSchema=True)
-                raw_dfs.append(temp_df)
-
+                # Polars reads the downloaded bytes directly, no temp file needed
+                raw_dfs.append(pl.read_csv(BytesIO(content), separator=",", has_header=True, infer_schema_length=1000))
             except Exception as e:
                 print(f"❌ Failed to process {file}: {e}")
 
-        if raw_dfs:
-            return raw_dfs[0].unionByName(*raw_dfs[1:]) if len(raw_dfs) > 1 else raw_dfs[0]
-        else:
-            return spark.createDataFrame([], schema=None)
+        # union by column name, filling columns missing from some files with nulls
+        return pl.concat(raw_dfs, how="diagonal_relaxed") if raw_dfs else pl.DataFrame()
     
     def fetch_blockdata(self, raw_df):
         """Split combined raw data into cleaned blocks based on data type keys."""
@@ -125,41 +171,50 @@ class SFTPDataFetcher:
             return
 
         keys = ["SUM", "OTS", "CHR", "CMI", "CTD", "CDC", "MID", "KDS"]
-        for key in keys:
-            block = raw_df[raw_df.iloc[:, 1] == key].reset_index(drop=True)
-            if not block.empty:
-                split_cols = block.iloc[:, 0].str.split("|", expand=True)
-                split_cols.columns = split_cols.iloc[0].astype(str)
-                self.data_blocks[key] = split_cols[1:].reset_index(drop=True)
-                for key in self.data_blocks:
-                    df = self.data_blocks[key]
-                    if key == "KDS":
-                        self.data_blocks[key] = df[df['guestcheckid'] != 'guestcheckid'].reset_index(drop=True)
-                    elif 'index' in df.columns:
-                        self.data_blocks[key] = df[df['index'] != 'index'].reset_index(drop=True)
-
-                     
-
-    def fetch_blockdata_spark(self, raw_df):
-        from pyspark.sql.functions import col, split
-
+        # split every row once, then hand out the rows per key in a single groupby pass;
+        # rows whose key isn't listed become NaN categories and are dropped by groupby
+        key_col = pd.Categorical(raw_df.iloc[:, 1], categories=keys)
+        split_all = raw_df.iloc[:, 0].str.split("|", expand=True)
+        for key, block in split_all.groupby(key_col, observed=True):
+            # drop the padding columns that only wider blocks needed
+            split_cols = block.dropna(axis=1, how="all").reset_index(drop=True)
+            split_cols.columns = split_cols.iloc[0].astype(str)
+            self.data_blocks[key] = split_cols[1:].reset_index(drop=True)
+
+        # header rows of every file after the first show up as data; drop them.
+        # Short rows leave <NA> in the Arrow-backed column, which must keep the row
+        for key, df in self.data_blocks.items():
+            if key == "KDS":
+                self.data_blocks[key] = df[df['guestcheckid'].ne('guestcheckid').fillna(True)].reset_index(drop=True)
+            elif 'index' in df.columns:
+                self.data_blocks[key] = df[df['index'].ne('index').fillna(True)].reset_index(drop=True)
+
+    def fetch_blockdata_polars(self, raw_df: pl.DataFrame):
+        """Split combined Polars raw data into blocks; use .to_pandas() on a block if needed."""
         self.data_blocks = {}
 
-        keys = ["SUM", "OTS", "CHR", "CMI", "CTD", "CDC", "MID", "KDS"]
-        for key in keys:
-            block_df = raw_df.filter(col(raw_df.columns[1]) == key)
-
-            if block_df.count() > 0:
-                # Split the first column into multiple columns
-                num_cols = block_df.select(split(col(block_df.columns[0]), "\\|")).first()[0]
-                n = len(num_cols)
+        if raw_df.is_empty():
+            print("⚠️ No data to split.")
+            return
 
-                # Apply split into separate columns
-                split_cols = split(col(block_df.columns[0]), "\\|")
-                for i in range(n):
-                    block_df = block_df.withColumn(f"col_{i}", split_cols.getItem(i))
+        data_col, key_col = raw_df.columns[0], raw_df.columns[1]
+        raw_df = raw_df.with_columns(pl.col(data_col).cast(pl.Utf8), pl.col(key_col).cast(pl.Utf8))
 
-                self.data_blocks[key] = block_df.drop(block_df.columns[0])  # drop original string col
+        keys = ["SUM", "OTS", "CHR", "CMI", "CTD", "CDC", "MID", "KDS"]
+        for key in keys:
+            block_df = raw_df.filter(pl.col(key_col) == key)
+
+            if block_df.height > 0:
+                # the first row decides how many columns the block splits into
+                n = len((block_df[data_col][0] or "").split("|"))
+
+                # split into col_0..col_{n-1} and drop the original string col
+                self.data_blocks[key] = block_df.with_columns(
+                    pl.col(data_col)
+                    .str.split_exact("|", n - 1)
+                    .struct.rename_fields([f"col_{i}" for i in range(n)])
+                    .alias("_split")
+                ).unnest("_split").drop(data_col)
 
 
     def fetch_data(self):